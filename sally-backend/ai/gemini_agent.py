@@ -3,38 +3,297 @@ Gemini AI Agent for Sally TSM
 Handles natural language to SQL conversion using Google Gemini API
 """
 
-import google.generativeai as genai
+import asyncio
+import functools
+import httpx
 import json
+import os
 import re
-from typing import Dict, List, Any, Optional
+import time
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+from typing import Dict, List, Any, Mapping, Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Gemini REST API
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+DEFAULT_MODEL = "gemini-2.5-flash"  # override with GEMINI_MODEL or the /config/llm model
+
+# Structured output schemas (Gemini JSON mode)
+_SQL_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "sql": {"type": "STRING"},
+        "explanation": {"type": "STRING"}
+    },
+    "required": ["sql", "explanation"]
+}
+
+_BATCH_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "id": {"type": "INTEGER"},
+            "sql": {"type": "STRING"},
+            "explanation": {"type": "STRING"}
+        },
+        "required": ["id", "sql", "explanation"]
+    }
+}
+
+# Prompt rules shared by single and batched SQL generation
+_SQL_RULES = """INSTRUCTIONS:
+1. Generate a safe SELECT SQL query to answer the user's question
+2. Use only tables and columns from the schema provided
+3. Include appropriate JOINs if multiple tables are needed
+4. Add WHERE clauses to filter relevant data
+5. Use aggregate functions (COUNT, SUM, AVG) when appropriate
+6. Add ORDER BY for better readability
+7. Limit results to prevent overwhelming data (LIMIT 100)
+
+SAFETY RULES:
+- ONLY generate SELECT queries
+- NO INSERT, UPDATE, DELETE, DROP, or any data modification
+- NO subqueries that could cause performance issues
+- NO UNION or complex nested queries unless necessary"""
+
+# Query normalization for caching
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Leading filler phrases dropped from cache keys so "Show me all sites" and
+# "list sites" share an entry. Only the start of the question is touched:
+# words elsewhere ("Phase I", "in US", "-20") can change the SQL.
+_NL_LEADING_FILLER_RE = re.compile(
+    r"^(?:(?:please|(?:can|could|would) you|i (?:want|would like|'d like) to see|"
+    r"show(?: me| us)?|list|display|give me|get(?: me)?|find(?: me)?|tell me|"
+    r"what (?:is|are|was|were)|the|all(?: of)?(?: the)?),?\s+)+"
+)
+# Closing punctuation only; punctuation inside the question is kept
+_NL_TRAILING_PUNCT_RE = re.compile(r"[\s?.!]+$")
+
+# Schema pruning: word tokens used to match questions to tables
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+_MIN_COLUMN_TOKEN_LEN = 3
+
+# orjson (optional - stdlib json used if not installed)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+def _json_loads(text):
+    """Parse JSON text (str or bytes)"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def _json_dumps_sorted(obj) -> str:
+    """Serialize with sorted keys, stringifying unknown types (stable hashing input)"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(
+            obj, default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+        ).decode()
+    return json.dumps(obj, sort_keys=True, default=str)
+
+
+class _KeywordMatcher:
+    """Finds occurrences of a fixed keyword set in a single pass over the text"""
+    
+    def __init__(self, keywords: List[str]):
+        self.keywords = tuple(keywords)
+        # Lookahead keeps overlapping matches, e.g. both "count" and "count of"
+        ordered = sorted(self.keywords, key=len, reverse=True)
+        alternation = "|".join(re.escape(k) for k in ordered)
+        self._pattern = re.compile(f"(?=({alternation}))")
+    
+    def iter(self, text: str):
+        """Yield every keyword found in text"""
+        for match in self._pattern.finditer(text):
+            yield match.group(1)
+
+
+# SQL safety validation
+_DANGEROUS_KEYWORDS = [
+    'drop', 'delete', 'truncate', 'alter', 'create',
+    'insert', 'update', 'grant', 'revoke', 'exec',
+    'execute', 'xp_', 'sp_', 'shutdown', 'backup',
+    'restore', 'use ', 'into outfile', 'into dumpfile',
+    'load_file', 'system', 'shell'
+]
+
+# Command-execution words also caught as identifier suffixes (sys_exec, sys_eval_shell)
+_SUFFIX_KEYWORDS = {'exec', 'execute', 'system', 'shell'}
+
+
+def _keyword_pattern(keyword: str) -> str:
+    """Whole-word pattern; 'xp_'-style prefixes match any procedure name they start"""
+    keyword = keyword.strip()
+    pattern = r'\s+'.join(re.escape(word) for word in keyword.split())
+    if keyword.endswith('_'):
+        return r'\b' + pattern
+    if keyword in _SUFFIX_KEYWORDS:
+        return r'(?:\b|_)' + pattern + r'\b'
+    return r'\b' + pattern + r'\b'
+
+
+# Word boundaries keep column names like last_updated or created_at from matching
+_DANGEROUS_RE = re.compile('|'.join(_keyword_pattern(k) for k in _DANGEROUS_KEYWORDS))
+
+_SUSPICIOUS_RE = re.compile(
+    r';\s*drop'     # Multiple statements
+    r'|--\s*drop'   # SQL injection attempt
+    r'|/\*.*\*/'    # Block comments (could hide malicious code)
+)
+
+# Intent detection: query types in priority order, entities in output order
+_QUERY_TYPE_KEYWORDS = {
+    'retrieve': ['show', 'list', 'display', 'get'],
+    'aggregate': ['count', 'how many', 'number of'],
+    'compare': ['compare', 'vs', 'versus', 'difference'],
+    'trend': ['trend', 'over time', 'timeline']
+}
+
+_ENTITY_KEYWORDS = {
+    'sites': ['site', 'location', 'facility'],
+    'inventory': ['inventory', 'stock', 'supplies'],
+    'shipments': ['shipment', 'delivery', 'shipping'],
+    'vendors': ['vendor', 'supplier'],
+    'studies': ['study', 'trial'],
+    'tasks': ['task', 'action', 'priority']
+}
+
+# keyword -> ("type" | "entity", value)
+_INTENT_KEYWORDS = {
+    **{kw: ("type", query_type) for query_type, kws in _QUERY_TYPE_KEYWORDS.items() for kw in kws},
+    **{kw: ("entity", entity) for entity, kws in _ENTITY_KEYWORDS.items() for kw in kws},
+}
+
+_INTENT_MATCHER = _KeywordMatcher(list(_INTENT_KEYWORDS))
+
 class GeminiAgent:
     """Gemini AI Agent for SQL generation and query processing"""
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, model: str = DEFAULT_MODEL,
+                 micro_batch_window_ms: int = 0, max_batch_size: int = 8,
+                 sql_cache_size: int = 1024, sql_cache_ttl: float = 3600.0):
         """
         Initialize Gemini Agent
         
         Args:
             api_key: Google Gemini API key
+            model: Gemini model name
+            micro_batch_window_ms: If > 0, concurrent generate_sql calls arriving
+                within this window are answered by one Gemini request
+            max_batch_size: Maximum number of questions per batched request
+            sql_cache_size: Number of generated SQL results kept in the LRU cache
+            sql_cache_ttl: Seconds a cached result stays valid (0 disables the cache)
         """
         self.api_key = api_key
         self.model = None
+        self.micro_batch_window_ms = micro_batch_window_ms
+        self.max_batch_size = max_batch_size
+        
+        # Micro-batching state (created on first batched call)
+        self._batch_queue: Optional[asyncio.Queue] = None
+        self._batch_task: Optional[asyncio.Task] = None
+        self._flush_tasks: set = set()
+        
+        # Generated SQL keyed by (normalized question, schema fingerprint)
+        self._sql_cache: OrderedDict = OrderedDict()
+        self._sql_cache_size = sql_cache_size
+        self._sql_cache_ttl = sql_cache_ttl
+        
+        # Shared HTTP client, created on first use so it binds to the running loop
+        self._client: Optional[httpx.AsyncClient] = None
+        
+        # Per-schema prompt state, rebuilt only when the schema changes
+        self._schema_key: Optional[str] = None
+        self._table_text: Dict[str, str] = {}
+        self._schema_index: Dict[str, set] = {}
+        self._table_links: Dict[str, set] = {}
+        self._entity_tables: Dict[str, set] = {}
         
         if api_key:
-            try:
-                genai.configure(api_key=api_key)
-                self.model = genai.GenerativeModel('gemini-pro')
-                logger.info("Gemini model initialized successfully")
-            except Exception as e:
-                logger.error(f"Failed to initialize Gemini: {e}")
-                self.model = None
+            self.model = model
+            logger.info("Gemini model initialized successfully")
         else:
             logger.warning("Gemini API key not provided")
     
+    def _get_client(self) -> httpx.AsyncClient:
+        """Return the pooled HTTP client used for all Gemini calls"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=GEMINI_API_BASE,
+                headers={"x-goog-api-key": self.api_key},
+                limits=httpx.Limits(
+                    max_connections=64,
+                    max_keepalive_connections=64,
+                    keepalive_expiry=60,
+                ),
+                timeout=httpx.Timeout(60.0, connect=10.0),
+            )
+        return self._client
+    
+    async def aclose(self):
+        """Stop the micro-batcher, fail pending questions and close the pooled HTTP client"""
+        tasks = list(self._flush_tasks)
+        if self._batch_task is not None:
+            tasks.append(self._batch_task)
+            self._batch_task = None
+        for task in tasks:
+            task.cancel()
+        # Flushes must finish before the client closes, or they would reopen it
+        await asyncio.gather(*tasks, return_exceptions=True)
+        
+        if self._batch_queue is not None:
+            while not self._batch_queue.empty():
+                _, _, future = self._batch_queue.get_nowait()
+                self._fail_pending(future)
+            self._batch_queue = None
+        
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def _generate_content(self, prompt: str, response_schema: Optional[Dict] = None) -> str:
+        """
+        Call Gemini generateContent over the shared connection pool
+        
+        Args:
+            prompt: Prompt text
+            response_schema: If given, request JSON output conforming to this schema
+            
+        Returns:
+            str: Text of the first candidate
+        """
+        body: Dict[str, Any] = {"contents": [{"parts": [{"text": prompt}]}]}
+        if response_schema is not None:
+            body["generationConfig"] = {
+                "responseMimeType": "application/json",
+                "responseSchema": response_schema,
+            }
+        
+        response = await self._get_client().post(
+            f"/models/{self.model}:generateContent",
+            json=body,
+        )
+        response.raise_for_status()
+        data = response.json()
+        
+        candidates = data.get("candidates") or []
+        if not candidates:
+            raise Exception(f"Gemini returned no candidates: {data.get('promptFeedback')}")
+        
+        parts = candidates[0].get("content", {}).get("parts", [])
+        return "".join(part.get("text", "") for part in parts)
+    
     async def test_connection(self) -> bool:
         """
         Test Gemini API connection
@@ -46,8 +305,8 @@ class GeminiAgent:
             return False
         
         try:
-            response = await self.model.generate_content_async("Hello, test connection")
-            return bool(response.text)
+            text = await self._generate_content("Hello, test connection")
+            return bool(text)
         except Exception as e:
             logger.error(f"Gemini connection test failed: {e}")
             return False
@@ -66,32 +325,209 @@ class GeminiAgent:
         if not self.model:
             raise Exception("Gemini API not configured")
         
+        cached = self._get_cached_sql(query, schema)
+        if cached is not None:
+            logger.info(f"SQL cache hit for query: {query}")
+            return cached
+        
+        if self.micro_batch_window_ms > 0:
+            return await self._submit_to_batch(query, schema)
+        
+        return await self._generate_single_sql(query, schema)
+    
+    async def answer(self, query: str, schema: Dict) -> Dict[str, Any]:
+        """
+        Generate SQL and analyze intent for a question concurrently
+        
+        Args:
+            query: Natural language question
+            schema: Database schema information
+            
+        Returns:
+            dict: 'sql' and 'explanation' from generate_sql plus 'intent'
+        """
+        intent, result = await asyncio.gather(
+            self.analyze_query_intent(query),
+            self.generate_sql(query, schema),
+        )
+        
+        return {**result, "intent": intent}
+    
+    async def _generate_single_sql(self, query: str, schema: Dict) -> Dict[str, str]:
+        """Generate SQL for one question with its own Gemini request"""
+        
+        # Only send the tables relevant to the question
+        tables = self._prune_schema(query, schema)
+        
         # Build comprehensive prompt
-        prompt = self._build_sql_generation_prompt(query, schema)
+        prompt = self._build_sql_generation_prompt(query, schema, tables)
         
         try:
             logger.info(f"Generating SQL for query: {query}")
-            response = await self.model.generate_content_async(prompt)
-            text = response.text
+            text = await self._generate_content(prompt, _SQL_RESPONSE_SCHEMA)
             
             # Parse response
             sql, explanation = self._parse_gemini_response(text)
             
             logger.info(f"Generated SQL: {sql}")
             
-            return {
+            result = {
                 "sql": sql,
                 "explanation": explanation
             }
+            self._cache_sql(query, schema, result)
+            
+            return result
         
         except Exception as e:
             logger.error(f"SQL generation failed: {str(e)}")
             raise Exception(f"Failed to generate SQL: {str(e)}")
     
-    def _build_sql_generation_prompt(self, query: str, schema: Dict) -> str:
+    async def generate_sql_batch(self, queries: List[str], schema: Dict) -> List[Dict[str, str]]:
+        """
+        Generate SQL for several questions with a single Gemini request
+        
+        The schema block is sent once and shared by all questions. Questions
+        missing from the reply are retried individually.
+        
+        Args:
+            queries: Natural language questions
+            schema: Database schema information
+            
+        Returns:
+            list: One dict with 'sql' and 'explanation' keys per question, in order
+        """
+        if not self.model:
+            raise Exception("Gemini API not configured")
+        
+        results: List[Optional[Dict[str, str]]] = [
+            self._get_cached_sql(query, schema) for query in queries
+        ]
+        pending = [i for i, result in enumerate(results) if result is None]
+        
+        if not pending:
+            return results
+        
+        if len(pending) == 1:
+            results[pending[0]] = await self._generate_single_sql(queries[pending[0]], schema)
+            return results
+        
+        pending_queries = [queries[i] for i in pending]
+        
+        # Union of the tables each question needs (full schema if any is unmatched)
+        tables: Optional[List[str]] = []
+        for query in pending_queries:
+            pruned = self._prune_schema(query, schema)
+            if pruned is None:
+                tables = None
+                break
+            tables.extend(name for name in pruned if name not in tables)
+        
+        prompt = self._build_batch_sql_prompt(pending_queries, schema, tables)
+        
+        try:
+            logger.info(f"Generating SQL for {len(pending_queries)} batched queries")
+            text = await self._generate_content(prompt, _BATCH_RESPONSE_SCHEMA)
+            parsed = self._parse_batch_response(text)
+        except Exception as e:
+            logger.error(f"Batched SQL generation failed: {str(e)}")
+            raise Exception(f"Failed to generate SQL: {str(e)}")
+        
+        missing = []
+        for number, i in enumerate(pending, start=1):
+            result = parsed.get(number)
+            if result is None:
+                missing.append(i)
+            else:
+                self._cache_sql(queries[i], schema, result)
+                results[i] = result
+        
+        if missing:
+            logger.warning(f"Batched reply missing {len(missing)} answers, retrying individually")
+            retried = await asyncio.gather(
+                *(self._generate_single_sql(queries[i], schema) for i in missing)
+            )
+            for i, result in zip(missing, retried):
+                results[i] = result
+        
+        return results
+    
+    async def _submit_to_batch(self, query: str, schema: Dict) -> Dict[str, str]:
+        """Queue a question for the micro-batcher and wait for its answer"""
+        if self._batch_queue is None:
+            self._batch_queue = asyncio.Queue()
+        if self._batch_task is None or self._batch_task.done():
+            self._batch_task = asyncio.create_task(self._run_batcher())
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._batch_queue.put((query, schema, future))
+        return await future
+    
+    async def _run_batcher(self):
+        """Collect queued questions for one window, then answer them together"""
+        loop = asyncio.get_running_loop()
+        window = self.micro_batch_window_ms / 1000
+        
+        while True:
+            batch = [await self._batch_queue.get()]
+            deadline = loop.time() + window
+            
+            try:
+                while len(batch) < self.max_batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._batch_queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                for _, _, future in batch:
+                    self._fail_pending(future)
+                raise
+            
+            # Flush in the background so the next window starts immediately
+            task = asyncio.create_task(self._flush_batch(batch))
+            self._flush_tasks.add(task)
+            task.add_done_callback(self._flush_tasks.discard)
+    
+    async def _flush_batch(self, batch: List[tuple]):
+        """Answer one collected batch, grouping questions by schema"""
+        groups: Dict[int, List[tuple]] = {}
+        for item in batch:
+            groups.setdefault(id(item[1]), []).append(item)
+        
+        for items in groups.values():
+            queries = [query for query, _, _ in items]
+            schema = items[0][1]
+            
+            try:
+                results = await self.generate_sql_batch(queries, schema)
+            except asyncio.CancelledError:
+                for _, _, future in batch:
+                    self._fail_pending(future)
+                raise
+            except Exception as e:
+                for _, _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, _, future), result in zip(items, results):
+                if not future.done():
+                    future.set_result(result)
+    
+    @staticmethod
+    def _fail_pending(future: asyncio.Future) -> None:
+        """Resolve a queued question whose batch will never be sent"""
+        if not future.done():
+            future.set_exception(Exception("Gemini agent was closed"))
+    
+    def _build_sql_generation_prompt(self, query: str, schema: Dict,
+                                     tables: Optional[List[str]] = None) -> str:
         """Build comprehensive prompt for SQL generation"""
         
-        schema_text = self._format_schema(schema)
+        schema_text = self._get_schema_text(schema, tables)
         
         prompt = f"""You are an expert SQL assistant for a Trial Supply Management (TSM) system.
 
@@ -100,57 +536,212 @@ DATABASE SCHEMA:
 
 USER QUESTION: {query}
 
-INSTRUCTIONS:
-1. Generate a safe SELECT SQL query to answer the user's question
-2. Use only tables and columns from the schema provided
-3. Include appropriate JOINs if multiple tables are needed
-4. Add WHERE clauses to filter relevant data
-5. Use aggregate functions (COUNT, SUM, AVG) when appropriate
-6. Add ORDER BY for better readability
-7. Limit results to prevent overwhelming data (LIMIT 100)
+{_SQL_RULES}
 
-SAFETY RULES:
-- ONLY generate SELECT queries
-- NO INSERT, UPDATE, DELETE, DROP, or any data modification
-- NO subqueries that could cause performance issues
-- NO UNION or complex nested queries unless necessary
+Return the SQL query and a brief explanation of what it returns."""
+        
+        return prompt
+    
+    def _build_batch_sql_prompt(self, queries: List[str], schema: Dict,
+                                tables: Optional[List[str]] = None) -> str:
+        """Build a single prompt answering several questions against one schema"""
+        
+        schema_text = self._get_schema_text(schema, tables)
+        questions = "\n".join(f"{i}. {q}" for i, q in enumerate(queries, start=1))
+        
+        prompt = f"""You are an expert SQL assistant for a Trial Supply Management (TSM) system.
 
-OUTPUT FORMAT:
-Provide your response in exactly this format:
+DATABASE SCHEMA:
+{schema_text}
 
-SQL:
-<your complete SQL query here>
+USER QUESTIONS:
+{questions}
 
-EXPLANATION:
-<brief explanation of what the query does and what it returns>
+Answer each question independently.
 
-Now generate the SQL query:"""
+{_SQL_RULES}
+
+Return one item per question, using the question number as its id."""
         
         return prompt
     
-    def _format_schema(self, schema: Dict) -> str:
-        """Format schema for prompt"""
-        if not schema or 'tables' not in schema:
-            return "No schema available"
+    def _schema_fingerprint(self, schema: Dict) -> str:
+        """Identify a schema version (explicit '_version' if provided, else its content)"""
+        if schema and schema.get('_version'):
+            return str(schema['_version'])
+        return _json_dumps_sorted(schema)
+    
+    def _sql_cache_key(self, query: str, schema: Dict) -> tuple:
+        """Cache key: normalized question plus schema fingerprint"""
+        self._load_schema(schema)
+        return _normalize_question(query), self._schema_key
+    
+    def _get_cached_sql(self, query: str, schema: Dict) -> Optional[Dict[str, str]]:
+        """Return a copy of the cached result for a question, if any and not expired"""
+        key = self._sql_cache_key(query, schema)
+        entry = self._sql_cache.get(key)
+        if entry is None:
+            return None
+        
+        expires_at, result = entry
+        if expires_at <= time.monotonic():
+            del self._sql_cache[key]
+            return None
+        
+        self._sql_cache.move_to_end(key)
+        return dict(result)
+    
+    def _cache_sql(self, query: str, schema: Dict, result: Dict[str, str]) -> None:
+        """Store a generated result, evicting the least recently used entry"""
+        if self._sql_cache_ttl <= 0 or self._sql_cache_size <= 0:
+            return
+        
+        key = self._sql_cache_key(query, schema)
+        self._sql_cache[key] = (time.monotonic() + self._sql_cache_ttl, dict(result))
+        self._sql_cache.move_to_end(key)
+        
+        while len(self._sql_cache) > self._sql_cache_size:
+            self._sql_cache.popitem(last=False)
+    
+    def clear_cache(self) -> None:
+        """Drop all cached SQL results"""
+        self._sql_cache.clear()
+    
+    def _load_schema(self, schema: Dict) -> None:
+        """Cache per-table prompt text and the pruning index for a schema"""
+        key = self._schema_fingerprint(schema)
+        if key == self._schema_key:
+            return
+        
+        tables = schema.get('tables', []) if schema else []
+        
+        self._table_text = {
+            table.get('name', 'unknown'): self._format_table(table) for table in tables
+        }
+        self._schema_index, self._table_links, self._entity_tables = (
+            self._build_schema_index(tables)
+        )
+        self._schema_key = key
+    
+    @staticmethod
+    def _stem(token: str) -> str:
+        """Crude singular form so 'sites' matches 'site' and 'studies' matches 'study'"""
+        if token.endswith('ies') and len(token) > 4:
+            return token[:-3] + 'y'
+        if token.endswith('s') and not token.endswith('ss') and len(token) > 3:
+            return token[:-1]
+        return token
+    
+    def _tokenize(self, text: str) -> set:
+        """Lowercased word stems, ignoring numeric literals"""
+        return {
+            self._stem(token) for token in _TOKEN_RE.findall(text.lower())
+            if not token.isdigit()
+        }
+    
+    def _build_schema_index(self, tables: List[Dict]) -> tuple:
+        """
+        Build the inverted index used for schema pruning
         
-        formatted = []
-        for table in schema.get('tables', []):
-            table_name = table.get('name', 'unknown')
-            columns = table.get('columns', [])
+        Returns:
+            tuple: ({token: table names},
+                    {table name: tables referenced via *_id columns},
+                    {intent entity: table names})
+        """
+        index: Dict[str, set] = {}
+        name_index: Dict[str, set] = {}
+        
+        for table in tables:
+            name = table.get('name', 'unknown')
+            for token in self._tokenize(name):
+                index.setdefault(token, set()).add(name)
+                name_index.setdefault(token, set()).add(name)
             
-            formatted.append(f"\nTable: {table_name}")
-            formatted.append("Columns:")
+            for col in table.get('columns', ()):
+                for token in self._tokenize(col.get('name', '')):
+                    if len(token) >= _MIN_COLUMN_TOKEN_LEN:
+                        index.setdefault(token, set()).add(name)
+        
+        # Seed the entity synonyms (supplier -> vendors, trial -> studies, ...)
+        entity_tables: Dict[str, set] = {}
+        for entity, keywords in _ENTITY_KEYWORDS.items():
+            names = set()
+            for token in self._tokenize(entity):
+                names.update(name_index.get(token, ()))
+            entity_tables[entity] = names
+            for keyword in keywords:
+                for token in self._tokenize(keyword):
+                    index.setdefault(token, set()).update(names)
+        
+        links: Dict[str, set] = {}
+        for table in tables:
+            name = table.get('name', 'unknown')
+            for col in table.get('columns', ()):
+                col_name = col.get('name', '').lower()
+                if col_name.endswith('_id'):
+                    target = self._stem(col_name[:-3])
+                    links.setdefault(name, set()).update(name_index.get(target, ()))
+        
+        return index, links, entity_tables
+    
+    def _prune_schema(self, query: str, schema: Dict) -> Optional[List[str]]:
+        """
+        Select the tables relevant to a question
+        
+        Tables match when their name, a synonym of it or one of their column
+        names appears in the question; tables referenced through *_id columns
+        are added so joins stay possible. If the question mentions an entity
+        that no matched table covers, the full schema is sent instead.
+        
+        Args:
+            query: Natural language question
+            schema: Database schema information
             
-            for col in columns:
-                col_name = col.get('name', 'unknown')
-                col_type = col.get('type', 'unknown')
-                formatted.append(f"  - {col_name} ({col_type})")
+        Returns:
+            list: Table names to include, or None to send the full schema
+        """
+        self._load_schema(schema)
+        
+        matched = set()
+        for token in self._tokenize(query):
+            matched.update(self._schema_index.get(token, ()))
         
-        return "\n".join(formatted)
+        if not matched:
+            return None
+        
+        _, entities = _detect_intent(_WHITESPACE_RE.sub(' ', query.lower().strip()))
+        for entity in entities:
+            if not self._entity_tables.get(entity, set()) & matched:
+                logger.info(f"No table matched entity '{entity}', sending full schema")
+                return None
+        
+        for name in list(matched):
+            matched.update(self._table_links.get(name, ()))
+        
+        logger.info(f"Schema pruned to {len(matched)}/{len(self._table_text)} tables")
+        return [name for name in self._table_text if name in matched]
+    
+    def _get_schema_text(self, schema: Dict, tables: Optional[List[str]] = None) -> str:
+        """Return formatted schema text for all tables, or only the given ones"""
+        if not schema or 'tables' not in schema:
+            return "No schema available"
+        
+        self._load_schema(schema)
+        
+        if tables is None:
+            return "\n".join(self._table_text.values())
+        return "\n".join(self._table_text[name] for name in tables)
+    
+    def _format_table(self, table: Dict) -> str:
+        """Format a single table for prompt"""
+        return f"\nTable: {table.get('name', 'unknown')}\nColumns:" + "".join(
+            f"\n  - {col.get('name', 'unknown')} ({col.get('type', 'unknown')})"
+            for col in table.get('columns', ())
+        )
     
     def _parse_gemini_response(self, text: str) -> tuple:
         """
-        Parse Gemini's response to extract SQL and explanation
+        Parse Gemini's JSON-mode response into SQL and explanation
         
         Args:
             text: Raw response from Gemini
@@ -158,30 +749,49 @@ Now generate the SQL query:"""
         Returns:
             tuple: (sql_query, explanation)
         """
-        # Try to extract SQL
-        sql_match = re.search(r'SQL:\s*(.+?)(?=EXPLANATION:|$)', text, re.DOTALL | re.IGNORECASE)
-        exp_match = re.search(r'EXPLANATION:\s*(.+)', text, re.DOTALL | re.IGNORECASE)
+        try:
+            data = _json_loads(text)
+            sql = data["sql"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise Exception(f"Malformed Gemini response: {e}")
         
-        if sql_match:
-            sql = sql_match.group(1).strip()
-        else:
-            # Fallback: try to find SQL in code blocks
-            code_block = re.search(r'```sql\s*(.+?)\s*```', text, re.DOTALL | re.IGNORECASE)
-            if code_block:
-                sql = code_block.group(1).strip()
-            else:
-                sql = text.strip()
+        explanation = data.get("explanation") or "Query generated by Gemini AI"
         
-        explanation = exp_match.group(1).strip() if exp_match else "Query generated by Gemini AI"
+        return self._clean_sql(sql), explanation
+    
+    def _parse_batch_response(self, text: str) -> Dict[int, Dict[str, str]]:
+        """
+        Parse a batched JSON-mode reply into numbered SQL/explanation pairs
         
+        Args:
+            text: Raw response from Gemini
+            
+        Returns:
+            dict: {question number: {'sql': ..., 'explanation': ...}}
+        """
+        try:
+            items = _json_loads(text)
+            return {
+                int(item["id"]): {
+                    "sql": self._clean_sql(item["sql"]),
+                    "explanation": item.get("explanation") or "Query generated by Gemini AI",
+                }
+                for item in items
+            }
+        except (ValueError, KeyError, TypeError) as e:
+            raise Exception(f"Malformed Gemini response: {e}")
+    
+    def _clean_sql(self, sql: str) -> str:
+        """Strip code fences and any text before SELECT"""
         # Clean SQL
         sql = sql.replace('```sql', '').replace('```', '').strip()
         
-        # Remove any text before SELECT
-        if 'select' in sql.lower():
-            sql = sql[sql.lower().index('select'):]
+        # Remove any text before SELECT (one lowercase copy, find instead of in + index)
+        start = sql.lower().find('select')
+        if start > 0:
+            sql = sql[start:]
         
-        return sql, explanation
+        return sql
     
     def is_safe_query(self, sql: str) -> bool:
         """
@@ -196,48 +806,21 @@ Now generate the SQL query:"""
         if not sql:
             return False
         
-        sql_lower = sql.lower().strip()
-        
-        # Must start with SELECT
-        if not sql_lower.startswith('select'):
-            logger.warning(f"Query rejected: Must start with SELECT")
+        # The verdict is memoized, so SQL re-executed from /query/ask is not rescanned
+        reason = _unsafe_query_reason(sql)
+        if reason:
+            logger.warning(f"Query rejected: {reason}")
             return False
         
-        # Block dangerous keywords
-        dangerous_keywords = [
-            'drop', 'delete', 'truncate', 'alter', 'create',
-            'insert', 'update', 'grant', 'revoke', 'exec',
-            'execute', 'xp_', 'sp_', 'shutdown', 'backup',
-            'restore', 'use ', 'into outfile', 'into dumpfile',
-            'load_file', 'system', 'shell'
-        ]
-        
-        for keyword in dangerous_keywords:
-            if keyword in sql_lower:
-                logger.warning(f"Query rejected: Contains dangerous keyword '{keyword}'")
-                return False
-        
-        # Check for suspicious patterns
-        suspicious_patterns = [
-            r';\s*drop',  # Multiple statements
-            r'--\s*drop',  # SQL injection attempt
-            r'/\*.*\*/',  # Block comments (could hide malicious code)
-        ]
-        
-        for pattern in suspicious_patterns:
-            if re.search(pattern, sql_lower):
-                logger.warning(f"Query rejected: Matches suspicious pattern")
-                return False
-        
         logger.info("Query validated: SAFE")
         return True
     
-    async def suggest_visualization(self, data: List[Dict]) -> Optional[Dict]:
+    async def suggest_visualization(self, data: List[Mapping[str, Any]]) -> Optional[Dict]:
         """
         Suggest appropriate visualization for query results
         
         Args:
-            data: Query result data
+            data: Query result rows (read-only mappings, e.g. sqlite3.Row)
             
         Returns:
             dict: Visualization suggestion or None
@@ -255,19 +838,20 @@ Now generate the SQL query:"""
             if len(columns) < 2:
                 return None
             
-            # Check for numerical data
-            numerical_cols = []
-            categorical_cols = []
-            
-            for col in columns:
-                sample_value = data[0][col]
-                if isinstance(sample_value, (int, float)):
-                    numerical_cols.append(col)
-                else:
-                    categorical_cols.append(col)
+            numerical_cols, temporal_cols, categorical_cols = self._classify_columns(data, columns)
             
             # Suggest visualization based on data structure
-            if len(categorical_cols) >= 1 and len(numerical_cols) >= 1:
+            if len(temporal_cols) >= 1 and len(numerical_cols) >= 1:
+                # Time vs Number -> Time series
+                return {
+                    "type": "line",
+                    "x_axis": temporal_cols[0],
+                    "y_axis": numerical_cols[0],
+                    "title": f"{numerical_cols[0]} over {temporal_cols[0]}",
+                    "description": "Time series trend"
+                }
+            
+            elif len(categorical_cols) >= 1 and len(numerical_cols) >= 1:
                 # Category vs Number -> Bar chart
                 return {
                     "type": "bar",
@@ -293,6 +877,35 @@ Now generate the SQL query:"""
             logger.error(f"Visualization suggestion failed: {e}")
             return None
     
+    @staticmethod
+    def _classify_columns(data: List[Mapping[str, Any]], columns: List[str]) -> tuple:
+        """
+        Split columns into numerical, temporal and categorical
+        
+        Each column is classified by its first non-null value across all
+        rows, so a NULL in the first row does not misclassify it.
+        
+        Returns:
+            tuple: (numerical columns, temporal columns, categorical columns)
+        """
+        numerical_cols = []
+        temporal_cols = []
+        categorical_cols = []
+        
+        for col in columns:
+            sample = next((row[col] for row in data if row[col] is not None), None)
+            
+            if isinstance(sample, bool):
+                categorical_cols.append(col)
+            elif isinstance(sample, (int, float, Decimal)):
+                numerical_cols.append(col)
+            elif isinstance(sample, date):
+                temporal_cols.append(col)
+            else:
+                categorical_cols.append(col)
+        
+        return numerical_cols, temporal_cols, categorical_cols
+    
     async def analyze_query_intent(self, query: str) -> Dict[str, Any]:
         """
         Analyze user query to understand intent
@@ -303,59 +916,120 @@ Now generate the SQL query:"""
         Returns:
             dict: Intent analysis
         """
-        query_lower = query.lower()
+        query_type, entities = _detect_intent(_WHITESPACE_RE.sub(' ', query.lower().strip()))
         
-        intent = {
-            "type": "general",
-            "entities": [],
+        return {
+            "type": query_type,
+            "entities": list(entities),
             "metrics": [],
             "filters": []
         }
-        
-        # Detect query type
-        if any(word in query_lower for word in ['show', 'list', 'display', 'get']):
-            intent["type"] = "retrieve"
-        elif any(word in query_lower for word in ['count', 'how many', 'number of']):
-            intent["type"] = "aggregate"
-        elif any(word in query_lower for word in ['compare', 'vs', 'versus', 'difference']):
-            intent["type"] = "compare"
-        elif any(word in query_lower for word in ['trend', 'over time', 'timeline']):
-            intent["type"] = "trend"
-        
-        # Detect entities
-        entities_map = {
-            'sites': ['site', 'location', 'facility'],
-            'inventory': ['inventory', 'stock', 'supplies'],
-            'shipments': ['shipment', 'delivery', 'shipping'],
-            'vendors': ['vendor', 'supplier'],
-            'studies': ['study', 'trial'],
-            'tasks': ['task', 'action', 'priority']
-        }
-        
-        for entity, keywords in entities_map.items():
-            if any(kw in query_lower for kw in keywords):
-                intent["entities"].append(entity)
-        
-        return intent
+
+
+@functools.lru_cache(maxsize=1024)
+def _unsafe_query_reason(sql: str) -> Optional[str]:
+    """Why a query is unsafe to execute, or None if it is safe (memoized)"""
+    sql_lower = sql.lower().strip()
+    
+    # Must start with SELECT
+    if not sql_lower.startswith('select'):
+        return "Must start with SELECT"
+    
+    # Block dangerous keywords (single pass over the query)
+    match = _DANGEROUS_RE.search(sql_lower)
+    if match:
+        return f"Contains dangerous keyword '{match.group(0).lstrip('_')}'"
+    
+    # Check for suspicious patterns
+    if _SUSPICIOUS_RE.search(sql_lower):
+        return "Matches suspicious pattern"
+    
+    return None
+
+
+@functools.lru_cache(maxsize=1024)
+def _normalize_question(query: str) -> str:
+    """Lowercase, collapse whitespace, drop leading filler and closing punctuation"""
+    normalized = _WHITESPACE_RE.sub(' ', query.lower().strip())
+    stripped = _NL_TRAILING_PUNCT_RE.sub('', _NL_LEADING_FILLER_RE.sub('', normalized))
+    # A question made only of filler words still needs a distinct key
+    return stripped or normalized
+
+
+@functools.lru_cache(maxsize=1024)
+def _detect_intent(query_lower: str) -> tuple:
+    """
+    Keyword-based intent detection on a normalized query (memoized)
+    
+    Returns:
+        tuple: (query type, tuple of entities)
+    """
+    types = set()
+    entities = set()
+    
+    # Single pass over the query for all type and entity keywords
+    for keyword in _INTENT_MATCHER.iter(query_lower):
+        kind, value = _INTENT_KEYWORDS[keyword]
+        if kind == "type":
+            types.add(value)
+        else:
+            entities.add(value)
+    
+    query_type = next((t for t in _QUERY_TYPE_KEYWORDS if t in types), "general")
+    entities = tuple(e for e in _ENTITY_KEYWORDS if e in entities)
+    
+    return query_type, entities
+
+
+# (key, model, micro-batch window, cache TTL) -> agent; unbounded, so agents
+# leave only through close_gemini_agent() and are never dropped unclosed
+_agents: Dict[tuple, GeminiAgent] = {}
 
 
 # Utility function for initialization
-def create_gemini_agent(api_key: Optional[str] = None) -> Optional[GeminiAgent]:
+def create_gemini_agent(api_key: Optional[str] = None,
+                        model: Optional[str] = None) -> Optional[GeminiAgent]:
     """
-    Factory function to create Gemini agent
+    Factory function to get the Gemini agent for an API key and model
+    
+    Agents are process-wide singletons per key and model, so repeated calls
+    reuse the same pooled HTTP client and caches. Release an agent that is
+    no longer used with close_gemini_agent().
     
     Args:
         api_key: Optional API key (will use env var if not provided)
+        model: Optional model name (falls back to GEMINI_MODEL, then DEFAULT_MODEL)
         
     Returns:
         GeminiAgent instance or None if not configured
     """
-    import os
-    
     key = api_key or os.getenv("GEMINI_API_KEY")
     
     if not key:
         logger.warning("No Gemini API key provided")
         return None
     
-    return GeminiAgent(api_key=key)
+    settings = (
+        key,
+        model or os.getenv("GEMINI_MODEL") or DEFAULT_MODEL,
+        int(os.getenv("GEMINI_MICRO_BATCH_MS", "0")),
+        float(os.getenv("GEMINI_SQL_CACHE_TTL", "3600")),
+    )
+    
+    agent = _agents.get(settings)
+    if agent is None:
+        agent = _agents[settings] = GeminiAgent(
+            api_key=settings[0],
+            model=settings[1],
+            micro_batch_window_ms=settings[2],
+            sql_cache_ttl=settings[3],
+        )
+    return agent
+
+
+async def close_gemini_agent(agent: GeminiAgent) -> None:
+    """Drop an agent from the registry and close its HTTP client and batcher"""
+    for settings, registered in list(_agents.items()):
+        if registered is agent:
+            del _agents[settings]
+    await agent.aclose()
@@ -0,0 +1,92 @@
+"""
+Query Result Cache - In-memory TTL + LRU cache for read-only query results
+"""
+
+from collections import OrderedDict
+from typing import Any, Optional
+import functools
+import re
+import time
+
+# Quoted literals/identifiers are kept verbatim when canonicalizing
+_QUOTED_RE = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`)""")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# Only keywords are case-folded: identifiers can be case-sensitive (e.g. MySQL tables)
+_KEYWORD_RE = re.compile(
+    r"\b(select|distinct|from|where|and|or|not|in|is|null|like|between|as|on|"
+    r"join|inner|left|right|full|outer|cross|group|by|order|asc|desc|having|"
+    r"limit|offset|union|all|case|when|then|else|end|with|exists)\b",
+    re.IGNORECASE,
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def canonical_sql(sql: str) -> str:
+    """
+    Normalize SQL text so trivially different spellings share a cache entry:
+    whitespace collapsed, keywords outside quotes lowercased, trailing ';' dropped
+    """
+    parts = _QUOTED_RE.split(sql)
+    # split() with a capturing group alternates unquoted / quoted segments
+    for i in range(0, len(parts), 2):
+        segment = _WHITESPACE_RE.sub(" ", parts[i])
+        parts[i] = _KEYWORD_RE.sub(lambda m: m.group(0).lower(), segment)
+    return "".join(parts).strip().rstrip(";").rstrip()
+
+
+class QueryCache:
+    """
+    Bounded cache mapping SQL text to result rows.
+    Keys are canonicalized with canonical_sql(). Entries expire after `ttl`
+    seconds; the least recently used entry is evicted once `maxsize` is
+    exceeded. Cached rows are shared between callers and must not be mutated.
+    """
+
+    def __init__(self, maxsize: int = 512, ttl: float = 30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value, or None if missing or expired"""
+        key = canonical_sql(key)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """Store a value for `ttl` seconds (defaults to the cache TTL)"""
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+
+        key = canonical_sql(key)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, pattern: str) -> int:
+        """Drop entries whose canonical SQL matches the regex `pattern` (case-insensitive)"""
+        regex = re.compile(pattern, re.IGNORECASE)
+        stale = [key for key in self._entries if regex.search(key)]
+        for key in stale:
+            del self._entries[key]
+        return len(stale)
+
+    def clear(self):
+        """Drop every entry"""
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,128 @@
+"""
+SQLite Connection Pool - asyncio.Queue of aiosqlite connections
+"""
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+import asyncio
+import itertools
+import sqlite3
+import threading
+
+import aiosqlite
+
+_MEMORY_DATABASES = ("", ":memory:")
+
+_connection_ids = itertools.count(1)
+
+
+class SQLitePool:
+    """
+    Small pool of aiosqlite connections with an asyncpg-style acquire().
+    File databases run in WAL mode so readers don't block each other or the
+    writer. An in-memory database is private to its connection, so the pool
+    is capped at one connection in that case.
+    """
+
+    def __init__(
+        self,
+        database: str,
+        min_size: int = 1,
+        max_size: int = 4,
+        busy_timeout_ms: int = 5000,
+    ):
+        self.database = database
+        self.in_memory = database in _MEMORY_DATABASES or "mode=memory" in database
+        self.max_size = 1 if self.in_memory else max(1, max_size)
+        self.min_size = min(max(1, min_size), self.max_size)
+        self.busy_timeout_ms = busy_timeout_ms
+
+        self._idle: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+        self._size = 0
+        self._closed = False
+
+    async def open(self) -> "SQLitePool":
+        """Open min_size connections up front"""
+        for _ in range(self.min_size):
+            self._size += 1
+            try:
+                self._idle.put_nowait(await self._new_connection())
+            except Exception:
+                self._size -= 1
+                await self.close()
+                raise
+        return self
+
+    async def _new_connection(self) -> aiosqlite.Connection:
+        # Each aiosqlite connection runs its calls on its own dedicated thread
+        # (no shared executor), so the pool size is also the SQLite thread count
+        conn = aiosqlite.connect(self.database)
+        if isinstance(conn, threading.Thread):
+            conn.name = f"sqlite-pool-{next(_connection_ids)}"
+        conn = await conn
+        # Rows are built as mappings in C, like asyncpg Records
+        conn.row_factory = sqlite3.Row
+        try:
+            await conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+            if not self.in_memory:
+                await conn.execute("PRAGMA journal_mode = WAL")
+                await conn.execute("PRAGMA synchronous = NORMAL")
+        except Exception:
+            await conn.close()
+            raise
+        return conn
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Borrow a connection, opening a new one if below max_size, else wait"""
+        if self._closed:
+            raise RuntimeError("SQLite pool is closed")
+
+        try:
+            conn = self._idle.get_nowait()
+        except asyncio.QueueEmpty:
+            if self._size < self.max_size:
+                self._size += 1
+                try:
+                    conn = await self._new_connection()
+                except Exception:
+                    self._size -= 1
+                    raise
+            else:
+                conn = await self._idle.get()
+
+        try:
+            yield conn
+        finally:
+            await self._release(conn)
+
+    async def _release(self, conn: aiosqlite.Connection):
+        """Return a connection to the pool, or close it if it can't be reused"""
+        if not self._closed and conn.in_transaction:
+            # A failed statement leaves sqlite3's implicit BEGIN open, which
+            # would hold the write lock for every other pooled connection
+            try:
+                await conn.rollback()
+            except Exception:
+                self._size -= 1
+                await conn.close()
+                return
+
+        if self._closed:
+            self._size -= 1
+            await conn.close()
+        else:
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        """Close idle connections now; borrowed ones close when released"""
+        self._closed = True
+        while not self._idle.empty():
+            conn = self._idle.get_nowait()
+            self._size -= 1
+            await conn.close()
+
+
+async def create_pool(database: str, **kwargs) -> SQLitePool:
+    """Create and open a SQLitePool (mirrors asyncpg.create_pool)"""
+    return await SQLitePool(database, **kwargs).open()
@@ -4,17 +4,22 @@ FastAPI backend for Sally Trial Supply Management Agent
 Supports: PostgreSQL, MySQL, Oracle, SQLite + Gemini AI
 """
 
-from fastapi import FastAPI, HTTPException, status
+from fastapi import Depends, FastAPI, HTTPException, Request, Response, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any, Literal
+import asyncio
+import hashlib
 import os
 import json
+import orjson
 from dotenv import load_dotenv
 import logging
 
 from database.manager import DatabaseManager
-from ai.gemini_agent import GeminiAgent
+from ai.gemini_agent import close_gemini_agent, create_gemini_agent
 
 # Load environment variables
 load_dotenv()
@@ -23,26 +28,55 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _orjson_default(obj):
+    """Serialize values orjson doesn't know natively"""
+    if hasattr(obj, "keys"):
+        # Mapping-like rows, e.g. asyncpg Records
+        return dict(obj)
+    # Everything else (Decimal, timedelta, bytes, IP addresses, ...) as FastAPI would
+    return jsonable_encoder(obj)
+
+class RowJSONResponse(ORJSONResponse):
+    """orjson response that serializes query rows directly, without copying them first"""
+    
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content,
+            default=_orjson_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        )
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Sally TSM Backend",
     description="AI-powered Trial Supply Management Backend with Gemini integration",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=RowJSONResponse
 )
 
-# CORS Configuration
+# CORS Configuration (CORS_ORIGINS: comma-separated list, defaults to any origin)
+cors_origins = [
+    origin.strip() for origin in os.getenv("CORS_ORIGINS", "*").split(",") if origin.strip()
+]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Configure for production
+    allow_origins=cors_origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Let browsers cache preflight responses for a day instead of re-sending OPTIONS
+    max_age=86400,
 )
 
 # Global instances
 db_manager = DatabaseManager()
 gemini_api_key = os.getenv("GEMINI_API_KEY", "")
-ai_agent = GeminiAgent(api_key=gemini_api_key) if gemini_api_key else None
+ai_agent = create_gemini_agent(gemini_api_key) if gemini_api_key else None
+
+async def get_db() -> DatabaseManager:
+    """Request dependency for the shared DatabaseManager (one per worker process)"""
+    return db_manager
 
 # ============================================================================
 # Pydantic Models
@@ -67,12 +101,13 @@ class DatabaseConfigRequest(BaseModel):
 class LLMConfigRequest(BaseModel):
     provider: Literal['gemini', 'openai', 'claude'] = Field(..., description="LLM provider")
     api_key: str = Field(..., description="API key for the LLM")
-    model: Optional[str] = Field("gemini-pro", description="Model name")
+    model: Optional[str] = Field(None, description="Model name (defaults to GEMINI_MODEL or gemini-2.5-flash)")
 
 class QueryResponse(BaseModel):
     success: bool
     sql: Optional[str] = None
     explanation: Optional[str] = None
+    intent: Optional[Dict[str, Any]] = None
     requires_approval: bool = True
 
 class ExecuteResponse(BaseModel):
@@ -118,7 +153,7 @@ async def health_check():
     }
 
 @app.post("/api/v1/query/ask", response_model=QueryResponse, tags=["Query"])
-async def process_query(request: QueryRequest):
+async def process_query(request: QueryRequest, db: DatabaseManager = Depends(get_db)):
     """
     Process natural language query with Gemini AI
     
@@ -132,18 +167,18 @@ async def process_query(request: QueryRequest):
                 detail="Gemini AI not configured. Please configure API key first."
             )
         
-        if not db_manager.is_connected():
+        if not db.is_connected():
             raise HTTPException(
                 status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
                 detail="Database not connected. Please configure database first."
             )
         
         # Get database schema
-        schema = await db_manager.get_schema()
+        schema = await db.get_schema()
         
-        # Generate SQL with Gemini
+        # Generate SQL with Gemini (intent analysis runs alongside)
         logger.info(f"Processing query: {request.query}")
-        result = await ai_agent.generate_sql(request.query, schema)
+        result = await ai_agent.answer(request.query, schema)
         
         logger.info(f"Generated SQL: {result['sql']}")
         
@@ -151,6 +186,7 @@ async def process_query(request: QueryRequest):
             success=True,
             sql=result["sql"],
             explanation=result["explanation"],
+            intent=result["intent"],
             requires_approval=True
         )
     
@@ -162,7 +198,7 @@ async def process_query(request: QueryRequest):
         )
 
 @app.post("/api/v1/query/execute", response_model=ExecuteResponse, tags=["Query"])
-async def execute_query(request: ExecuteRequest):
+async def execute_query(request: ExecuteRequest, db: DatabaseManager = Depends(get_db)):
     """
     Execute approved SQL query
     
@@ -170,7 +206,7 @@ async def execute_query(request: ExecuteRequest):
     Returns data and optional visualization suggestions
     """
     try:
-        if not db_manager.is_connected():
+        if not db.is_connected():
             raise HTTPException(
                 status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
                 detail="Database not connected"
@@ -185,7 +221,7 @@ async def execute_query(request: ExecuteRequest):
         
         # Execute query
         logger.info(f"Executing SQL: {request.sql_query}")
-        data = await db_manager.execute_query(request.sql_query)
+        data = await db.execute_query(request.sql_query)
         
         # Generate visualization suggestion if requested
         visualization = None
@@ -196,7 +232,8 @@ async def execute_query(request: ExecuteRequest):
         
         return ExecuteResponse(
             success=True,
-            data=data,
+            # The response model needs real dicts
+            data=[row if isinstance(row, dict) else dict(row) for row in data],
             visualization=visualization,
             row_count=len(data) if data else 0
         )
@@ -209,6 +246,62 @@ async def execute_query(request: ExecuteRequest):
             row_count=0
         )
 
+@app.post("/api/v1/query/stream", tags=["Query"])
+async def stream_query(request: ExecuteRequest, db: DatabaseManager = Depends(get_db)):
+    """
+    Execute approved SQL query, streaming rows as NDJSON
+    
+    Rows are fetched through a server-side cursor in chunks, so large
+    results are never held in memory in full. Visualization is not included.
+    """
+    if not db.is_connected():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Database not connected"
+        )
+    
+    if not ai_agent or not ai_agent.is_safe_query(request.sql_query):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Unsafe query detected. Only SELECT queries are allowed."
+        )
+    
+    logger.info(f"Streaming SQL: {request.sql_query}")
+    
+    # Fetch the first chunk before sending headers, so a bad query is an error
+    # response rather than an empty 200 stream
+    chunks = db.stream_query(request.sql_query)
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except Exception as e:
+        logger.error(f"Query streaming error: {str(e)}")
+        await chunks.aclose()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Query execution failed: {str(e)}"
+        )
+    
+    def encode(chunk) -> bytes:
+        return b"".join(orjson.dumps(row, default=_orjson_default) + b"\n" for row in chunk)
+    
+    async def ndjson_rows():
+        if first is None:
+            return
+        try:
+            yield encode(first)
+            async for chunk in chunks:
+                yield encode(chunk)
+        except Exception as e:
+            # Headers are already sent; end with an error record instead
+            logger.error(f"Query streaming error: {str(e)}")
+            yield orjson.dumps({"error": str(e)}) + b"\n"
+        finally:
+            await chunks.aclose()
+    
+    return StreamingResponse(ndjson_rows(), media_type="application/x-ndjson")
+
 @app.post("/api/v1/config/database", response_model=ConfigResponse, tags=["Configuration"])
 async def configure_database(config: DatabaseConfigRequest):
     """
@@ -258,8 +351,11 @@ async def configure_llm(config: LLMConfigRequest):
     try:
         logger.info(f"Configuring LLM: {config.provider}")
         
-        # Create new agent with provided key
-        ai_agent = GeminiAgent(api_key=config.api_key)
+        # Get the agent for the provided key and model (reused if already created)
+        agent = create_gemini_agent(config.api_key, config.model)
+        if ai_agent and ai_agent is not agent:
+            await close_gemini_agent(ai_agent)
+        ai_agent = agent
         
         # Test connection
         success = await ai_agent.test_connection()
@@ -272,6 +368,7 @@ async def configure_llm(config: LLMConfigRequest):
             )
         else:
             logger.warning("LLM connection test failed")
+            await close_gemini_agent(ai_agent)
             ai_agent = None
             return ConfigResponse(
                 success=False,
@@ -281,6 +378,8 @@ async def configure_llm(config: LLMConfigRequest):
     
     except Exception as e:
         logger.error(f"LLM configuration error: {str(e)}")
+        if ai_agent:
+            await close_gemini_agent(ai_agent)
         ai_agent = None
         return ConfigResponse(
             success=False,
@@ -308,88 +407,149 @@ async def get_config_status():
 # Data Endpoints (Convenience methods for common queries)
 # ============================================================================
 
-@app.get("/api/v1/data/sites", tags=["Data"])
-async def get_sites():
-    """Get all sites"""
+_DATA_QUERIES = {
+    "sites": "SELECT * FROM sites ORDER BY name",
+    "inventory": "SELECT * FROM inventory ORDER BY last_updated DESC",
+    "shipments": "SELECT * FROM shipments ORDER BY shipped_date DESC",
+    "studies": "SELECT * FROM studies ORDER BY name",
+    "vendors": "SELECT * FROM vendors ORDER BY name",
+    "tasks": "SELECT * FROM tasks ORDER BY due_date",
+}
+
+# name -> (rows object, JSON body, ETag). Rows come from the manager's result
+# cache, so the same object means unchanged data and the body can be reused.
+_data_bodies: Dict[str, tuple] = {}
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header covers the ETag (weak comparison)"""
+    if not if_none_match:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
+async def _data_response(name: str, request: Request, db: DatabaseManager) -> Response:
+    """Rows for a data endpoint as JSON with an ETag; 304 if the client copy is current"""
     try:
-        if not db_manager.is_connected():
-            return []
+        if not db.is_connected():
+            return RowJSONResponse([])
+        
+        data = await db.execute_query(_DATA_QUERIES[name])
         
-        data = await db_manager.execute_query("SELECT * FROM sites ORDER BY name")
-        return data or []
+        cached = _data_bodies.get(name)
+        if cached and cached[0] is data:
+            _, body, etag = cached
+        else:
+            # Rows skip jsonable_encoder and are serialized/hashed once per result
+            body = RowJSONResponse(data or []).body
+            etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+            _data_bodies[name] = (data, body, etag)
+        
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
     except Exception as e:
-        logger.error(f"Error fetching sites: {str(e)}")
-        return []
+        logger.error(f"Error fetching {name}: {str(e)}")
+        return RowJSONResponse([])
+
+@app.get("/api/v1/data/sites", tags=["Data"])
+async def get_sites(request: Request, db: DatabaseManager = Depends(get_db)):
+    """Get all sites"""
+    return await _data_response("sites", request, db)
 
 @app.get("/api/v1/data/inventory", tags=["Data"])
-async def get_inventory():
+async def get_inventory(request: Request, db: DatabaseManager = Depends(get_db)):
     """Get all inventory"""
-    try:
-        if not db_manager.is_connected():
-            return []
-        
-        data = await db_manager.execute_query("SELECT * FROM inventory ORDER BY last_updated DESC")
-        return data or []
-    except Exception as e:
-        logger.error(f"Error fetching inventory: {str(e)}")
-        return []
+    return await _data_response("inventory", request, db)
 
 @app.get("/api/v1/data/shipments", tags=["Data"])
-async def get_shipments():
+async def get_shipments(request: Request, db: DatabaseManager = Depends(get_db)):
     """Get all shipments"""
-    try:
-        if not db_manager.is_connected():
-            return []
-        
-        data = await db_manager.execute_query("SELECT * FROM shipments ORDER BY shipped_date DESC")
-        return data or []
-    except Exception as e:
-        logger.error(f"Error fetching shipments: {str(e)}")
-        return []
+    return await _data_response("shipments", request, db)
 
 @app.get("/api/v1/data/studies", tags=["Data"])
-async def get_studies():
+async def get_studies(request: Request, db: DatabaseManager = Depends(get_db)):
     """Get all studies"""
-    try:
-        if not db_manager.is_connected():
-            return []
-        
-        data = await db_manager.execute_query("SELECT * FROM studies ORDER BY name")
-        return data or []
-    except Exception as e:
-        logger.error(f"Error fetching studies: {str(e)}")
-        return []
+    return await _data_response("studies", request, db)
 
 @app.get("/api/v1/data/vendors", tags=["Data"])
-async def get_vendors():
+async def get_vendors(request: Request, db: DatabaseManager = Depends(get_db)):
     """Get all vendors"""
-    try:
-        if not db_manager.is_connected():
-            return []
-        
-        data = await db_manager.execute_query("SELECT * FROM vendors ORDER BY name")
-        return data or []
-    except Exception as e:
-        logger.error(f"Error fetching vendors: {str(e)}")
-        return []
+    return await _data_response("vendors", request, db)
 
 @app.get("/api/v1/data/tasks", tags=["Data"])
-async def get_tasks():
+async def get_tasks(request: Request, db: DatabaseManager = Depends(get_db)):
     """Get all tasks"""
-    try:
-        if not db_manager.is_connected():
-            return []
-        
-        data = await db_manager.execute_query("SELECT * FROM tasks ORDER BY due_date")
-        return data or []
-    except Exception as e:
-        logger.error(f"Error fetching tasks: {str(e)}")
-        return []
+    return await _data_response("tasks", request, db)
+
+@app.get("/api/v1/data/summary", tags=["Data"])
+async def get_summary(db: DatabaseManager = Depends(get_db)):
+    """Get sites, inventory, shipments, studies, vendors and tasks in one call"""
+    if not db.is_connected():
+        return {name: [] for name in _DATA_QUERIES}
+    
+    # The reads are independent, so run them concurrently on the pool
+    results = await db.execute_many(list(_DATA_QUERIES.values()), return_exceptions=True)
+    
+    # Serialize each section separately so one bad value only empties its own section
+    sections = []
+    for name, data in zip(_DATA_QUERIES, results):
+        if isinstance(data, Exception):
+            logger.error(f"Error fetching {name}: {str(data)}")
+            data = []
+        try:
+            body = RowJSONResponse(data or []).body
+        except Exception as e:
+            logger.error(f"Error serializing {name}: {str(e)}")
+            body = b"[]"
+        sections.append(orjson.dumps(name) + b":" + body)
+    
+    return Response(content=b"{" + b",".join(sections) + b"}", media_type="application/json")
+
+@app.get("/api/v1/data/counts", tags=["Data"])
+async def get_counts(db: DatabaseManager = Depends(get_db)):
+    """Get approximate row counts for the data tables (null if unavailable)"""
+    if not db.is_connected():
+        return {name: None for name in _DATA_QUERIES}
+    
+    results = await asyncio.gather(
+        *(db.fast_row_count(name) for name in _DATA_QUERIES),
+        return_exceptions=True
+    )
+    
+    counts = {}
+    for name, count in zip(_DATA_QUERIES, results):
+        if isinstance(count, Exception):
+            logger.error(f"Error counting {name}: {str(count)}")
+            count = None
+        counts[name] = count
+    
+    return counts
 
 # ============================================================================
 # Startup Event
 # ============================================================================
 
+def database_config_from_env() -> Optional[Dict[str, Any]]:
+    """Database config from DATABASE_URL (Postgres) or the DB_* variables, if set"""
+    db_url = os.getenv("DATABASE_URL")
+    if db_url:
+        return {"type": "postgresql", "dsn": db_url}
+    
+    db_type = os.getenv("DB_TYPE")
+    if not db_type:
+        return None
+    
+    config = {
+        "type": db_type,
+        "host": os.getenv("DB_HOST"),
+        "port": int(os.getenv("DB_PORT")) if os.getenv("DB_PORT") else None,
+        "database": os.getenv("DB_NAME"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASSWORD"),
+    }
+    return {key: value for key, value in config.items() if value is not None}
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize services on startup"""
@@ -402,32 +562,52 @@ async def startup_event():
     else:
         logger.warning("⚠ Gemini API key not configured")
     
+    # Open the pool now so the first request doesn't pay for the handshakes
+    db_config = database_config_from_env()
+    if db_config:
+        try:
+            await db_manager.connect(db_config)
+            logger.info(f"✓ Database connected ({db_manager.db_type})")
+        except Exception as e:
+            logger.warning(f"⚠ Database connection failed: {str(e)}")
+    else:
+        logger.warning("⚠ Database not configured")
+    
     logger.info("="*60)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release pooled connections on shutdown"""
+    if ai_agent:
+        await close_gemini_agent(ai_agent)
+    
+    await db_manager.disconnect()
+
 @app.get("/api/v1/database/test")
-async def test_database():
+async def test_database(db: DatabaseManager = Depends(get_db)):
     """Test database connection"""
-    import os
-    import psycopg2
-    
     db_url = os.getenv("DATABASE_URL")
+    use_pool = db.is_connected() and db.db_type == "postgres"
     
-    if not db_url:
+    if not db_url and not use_pool:
         return {
             "success": False,
             "message": "DATABASE_URL not configured"
         }
     
     try:
-        # Try to connect
-        conn = psycopg2.connect(db_url)
-        cursor = conn.cursor()
-        
-        # Test query
-        cursor.execute("SELECT version();")
-        version = cursor.fetchone()[0]
-        
-        cursor.close()
-        conn.close()
+        if use_pool:
+            # Borrow a connection from the already-open pool
+            async with db.connection.acquire() as conn:
+                version = await conn.fetchval("SELECT version()")
+        else:
+            import asyncpg
+            
+            conn = await asyncpg.connect(db_url, timeout=10)
+            try:
+                version = await conn.fetchval("SELECT version()")
+            finally:
+                await conn.close()
         
         return {
             "success": True,
@@ -446,16 +626,26 @@ async def test_database():
 # ============================================================================
 
 if __name__ == "__main__":
+    import importlib.util
     import uvicorn
     
     port = int(os.getenv("API_PORT", 8000))
     host = os.getenv("API_HOST", "0.0.0.0")
+    workers = int(os.getenv("API_WORKERS", 1))
+    
+    # uvloop/httptools ship with uvicorn[standard]; fall back to asyncio/h11 without them
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
     
-    logger.info(f"Starting server on {host}:{port}")
+    logger.info(f"Starting server on {host}:{port} (loop={loop}, http={http}, workers={workers})")
     
     uvicorn.run(
-        app,
+        # Multiple workers need an import string so each process loads its own app
+        "main:app" if workers > 1 else app,
         host=host,
         port=port,
+        loop=loop,
+        http=http,
+        workers=workers,
         log_level="info"
     )